@@ -1,11 +1,28 @@
+# eventlet must patch the stdlib (socket, ssl, threading, time) before anything
+# else imports it, so requests/urllib3 and the scan thread pool run cooperatively.
+import eventlet
+eventlet.monkey_patch()
+
 import os
 import time
 import logging
+import threading
+import hashlib
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from collections import namedtuple
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TLRUCache, TTLCache, cached
 from datetime import datetime, timezone
 from urllib.parse import quote_plus
 from dotenv import load_dotenv
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
+from flask.json.provider import DefaultJSONProvider, JSONProvider
 import requests
+import orjson
+import numpy as np
+import diskcache
 
 # WebSocket
 from flask_socketio import SocketIO, emit, join_room, leave_room
@@ -77,14 +94,56 @@ HEADERS = {
 
 INDEX_SYMBOLS = {"NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"}
 
+# Multi-symbol scans fan out over a thread pool; NSE_MAX_RPS caps the
+# combined rate of outgoing NSE requests (see get_json) across all threads.
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "16"))
+NSE_MAX_RPS = float(os.getenv("NSE_MAX_RPS", "10"))
+# NSE refreshes option chains every few seconds; identical fetches inside
+# this window (concurrent clients, overlapping scans) are served from memory.
+OC_CACHE_TTL = float(os.getenv("OC_CACHE_TTL", "5"))
+# Optional on-disk layer shared by all gunicorn workers on the host; unset = in-process only.
+OC_CACHE_DIR = os.getenv("OC_CACHE_DIR")
+
 s = requests.Session()
 s.headers.update(HEADERS)
+# Keep one pooled keep-alive connection per scan worker so concurrent
+# fetches reuse TLS sessions instead of discarding/reopening them.
+_nse_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=max(SCAN_WORKERS, 10), pool_block=True
+)
+s.mount("https://", _nse_adapter)
+
+
+class RateLimiter:
+    """Thread-safe token bucket: acquire() blocks until a slot is free."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_nse_limiter = RateLimiter(NSE_MAX_RPS)
 
 
 def safe_float(val):
     """Safely convert to float."""
     if val is None:
         return None
+    # Kept as a plain try: it costs nothing when no exception is raised (CPython 3.11+),
+    # and isinstance/type fast paths measured slower for float, int and str inputs.
     try:
         return float(val)
     except (ValueError, TypeError):
@@ -97,103 +156,200 @@ def prime():
         s.get(BASE + "/option-chain", timeout=10)
         logger.info("Session primed successfully")
     except requests.RequestException as e:
-        logger.warning(f"Session priming failed: {e}")
+        logger.warning("Session priming failed: %s", e)
 
 
 def get_json(url, retries=3):
     for _ in range(retries):
+        _nse_limiter.acquire()
         try:
             r = s.get(url, timeout=12)
             if r.status_code == 200:
-                return r.json()
+                return orjson.loads(r.content)
             if r.status_code in (401, 403):
                 prime()
             time.sleep(0.5)
         except requests.RequestException as e:
-            logger.warning(f"Request exception for {url}: {e}")
+            logger.warning("Request exception for %s: %s", url, e)
             prime()
             time.sleep(0.5)
-    logger.error(f"NSE fetch failed for URL: {url}")
+    logger.error("NSE fetch failed for URL: %s", url)
     raise RuntimeError("NSE fetch failed")
 
 
+_oc_disk_cache = diskcache.Cache(OC_CACHE_DIR) if OC_CACHE_DIR else None
+
+
+def fetch_oc(url):
+    """
+    get_json() for option-chain URLs, returned as (fetched_at, oc_json) where
+    fetched_at is the wall-clock time NSE served it. Not memoized in-process:
+    fetch_chain() is the L1 and keeps only the parsed chain. With OC_CACHE_DIR
+    set, the shared disk cache is checked before NSE.
+    """
+    if _oc_disk_cache is None:
+        oc = get_json(url)
+        return time.time(), oc
+    entry = _oc_disk_cache.get(url)
+    if entry is None:
+        oc = get_json(url)
+        entry = (time.time(), oc)
+        _oc_disk_cache.set(url, entry, expire=OC_CACHE_TTL)
+    return entry
+
+
+# Entries expire OC_CACHE_TTL after NSE served the chain, not after this process
+# read it, so a chain picked up late from the disk cache isn't kept for ~2x TTL.
+# Wall-clock time because fetched_at is shared between worker processes.
+@cached(
+    cache=TLRUCache(maxsize=512, ttu=lambda _url, entry, _now: entry[0] + OC_CACHE_TTL, timer=time.time),
+    condition=threading.Condition(),
+)
+def _fetch_chain_entry(url):
+    fetched_at, oc = fetch_oc(url)
+    return fetched_at, parse_rows(oc)
+
+
+def fetch_chain(url):
+    """parse_rows() of fetch_oc(url), shared by every caller until the chain is OC_CACHE_TTL old."""
+    return _fetch_chain_entry(url)[1]
+
+
+@lru_cache(maxsize=512)
 def oc_url(symbol):
     symbol = symbol.upper().strip()
+    # Only a few F&O symbols (M&M, BAJAJ-AUTO) need escaping
+    quoted = symbol if symbol.isascii() and symbol.isalnum() else quote_plus(symbol)
     if symbol in INDEX_SYMBOLS:
-        return f"{BASE}/api/option-chain-indices?symbol={quote_plus(symbol)}"
-    return f"{BASE}/api/option-chain-equities?symbol={quote_plus(symbol)}"
+        return f"{BASE}/api/option-chain-indices?symbol={quoted}"
+    return f"{BASE}/api/option-chain-equities?symbol={quoted}"
 
 
 def parse_rows(oc_json, chosen_expiry=None):
     if not oc_json or "records" not in oc_json:
         logger.warning("Invalid OC JSON structure")
-        return {"rows": [], "expiries": [], "underlying": None, "symbol_name": None}
+        return {"rows": [], "by_expiry": {}, "expiries": [], "underlying": None, "symbol_name": None}
     rec = oc_json["records"]
     expiries = rec.get("expiryDates", []) or []
     data = rec.get("data", []) or []
     symbol_name = rec.get("index") or rec.get("underlying")
     underlying = safe_float(rec.get("underlyingValue"))
+    # Hot path: one pass, no intermediate lists; strike-less items are
+    # skipped before their row dict is ever built.
     rows = []
+    append = rows.append
+    to_float = safe_float
     for item in data:
-        strike = safe_float(item.get("strikePrice"))
         expiry = item.get("expiryDate")
         if chosen_expiry and expiry != chosen_expiry:
             continue
+        strike = to_float(item.get("strikePrice"))
+        if strike is None:
+            continue
         ce = item.get("CE") or {}
         pe = item.get("PE") or {}
-        rows.append({
+        append({
             "symbol": symbol_name,
             "underlying": underlying,
             "expiry": expiry,
             "strike": strike,
-            "CE_iv": safe_float(ce.get("impliedVolatility")),
-            "PE_iv": safe_float(pe.get("impliedVolatility")),
-            "CE_ltp": safe_float(ce.get("lastPrice")),
-            "PE_ltp": safe_float(pe.get("lastPrice")),
-            "CE_vol": safe_float(ce.get("totalTradedVolume") or ce.get("lastTradedVolume") or ce.get("totalTradedQty")),
-            "PE_vol": safe_float(pe.get("totalTradedVolume") or pe.get("lastTradedVolume") or pe.get("totalTradedQty")),
+            "CE_iv": to_float(ce.get("impliedVolatility")),
+            "PE_iv": to_float(pe.get("impliedVolatility")),
+            "CE_ltp": to_float(ce.get("lastPrice")),
+            "PE_ltp": to_float(pe.get("lastPrice")),
+            "CE_vol": to_float(ce.get("totalTradedVolume") or ce.get("lastTradedVolume") or ce.get("totalTradedQty")),
+            "PE_vol": to_float(pe.get("totalTradedVolume") or pe.get("lastTradedVolume") or pe.get("totalTradedQty")),
         })
-    rows = [r for r in rows if r["strike"] is not None]
-    rows.sort(key=lambda r: r["strike"])
-    return {"rows": rows, "expiries": expiries, "underlying": underlying, "symbol_name": symbol_name}
-
+    rows.sort(key=itemgetter("strike"))
 
-def nearest_strike_iv(rows, under, side):
-    best, bestd = None, float('inf')
+    # Group the (already strike-sorted) rows per expiry so picking an
+    # expiry is a dict lookup rather than a re-parse or re-filter.
+    by_expiry = {}
     for r in rows:
-        iv = r.get(f"{side}_iv")
-        if iv is None:
-            continue
-        strike = r["strike"]
-        if strike is None:
-            continue
-        d = abs(strike - under)
-        if d < bestd:
-            best, bestd = r, d
-    if not best:
-        return None, None
-    return best["strike"], best.get(f"{side}_iv")
+        group = by_expiry.get(r["expiry"])
+        if group is None:
+            by_expiry[r["expiry"]] = [r]
+        else:
+            group.append(r)
+    return {"rows": rows, "by_expiry": by_expiry, "expiries": expiries, "underlying": underlying, "symbol_name": symbol_name}
 
 
-def get_straddle_info(rows, underlying):
-    if not rows or underlying is None:
-        return None, None, None, None
+def rows_for_expiry(parsed, expiry):
+    """Rows of a parse_rows() result limited to one expiry (all rows if None)."""
+    if not expiry:
+        return parsed["rows"]
+    return parsed["by_expiry"].get(expiry, [])
 
-    atm_strike = None
-    for r in rows:
-        if r["strike"] and abs(r["strike"] - underlying) < 0.1:
-            atm_strike = r["strike"]
+
+AtmSummary = namedtuple("AtmSummary", [
+    "atm_strike", "ce_row", "pe_row", "atm_ce_iv", "atm_pe_iv", "atm_ce_ltp", "atm_pe_ltp",
+])
+
+
+_strike_key = itemgetter("strike")
+
+
+def _nearest_row(rows, hi, underlying, field):
+    """
+    Nearest row to the underlying whose `field` is not None, given hi = first
+    index with strike >= underlying. Ties go to the lower strike / earlier row.
+    """
+    left = None
+    for i in range(hi - 1, -1, -1):
+        r = rows[i]
+        if left is not None and r["strike"] != left["strike"]:
+            break
+        if r.get(field) is not None:
+            left = r
+    right = None
+    for i in range(hi, len(rows)):
+        if rows[i].get(field) is not None:
+            right = rows[i]
             break
-    if not atm_strike:
-        atm_strike = min(rows, key=lambda x: abs(x["strike"] - underlying))["strike"]
+    if left is None or right is None:
+        return left or right
+    return left if underlying - left["strike"] <= right["strike"] - underlying else right
 
-    ce_row = None
-    pe_row = None
-    for r in rows:
-        if r["strike"] == atm_strike:
+
+def _summarize_rows(rows, underlying):
+    """
+    ATM lookups on strike-sorted rows via bisect (O(log N) plus a few neighbours):
+    - atm_strike / ce_row / pe_row: the nearest strike and its rows carrying a CE/PE LTP
+      (the straddle legs)
+    - atm_ce_* / atm_pe_*: IV and LTP of the nearest strike that has a CE/PE IV
+    """
+    hi = bisect_left(rows, underlying, key=_strike_key)
+    atm_row = _nearest_row(rows, hi, underlying, "strike")
+    atm_strike = atm_row["strike"] if atm_row else None
+
+    ce_row = pe_row = None
+    if atm_row:
+        lo = bisect_left(rows, atm_strike, key=_strike_key)
+        for r in rows[lo:bisect_right(rows, atm_strike, lo=lo, key=_strike_key)]:
             if r.get("CE_ltp"): ce_row = r
             if r.get("PE_ltp"): pe_row = r
 
+    ce_iv_row = _nearest_row(rows, hi, underlying, "CE_iv")
+    pe_iv_row = _nearest_row(rows, hi, underlying, "PE_iv")
+
+    return AtmSummary(
+        atm_strike=atm_strike,
+        ce_row=ce_row,
+        pe_row=pe_row,
+        atm_ce_iv=ce_iv_row["CE_iv"] if ce_iv_row else None,
+        atm_pe_iv=pe_iv_row["PE_iv"] if pe_iv_row else None,
+        atm_ce_ltp=ce_iv_row.get("CE_ltp") if ce_iv_row else None,
+        atm_pe_ltp=pe_iv_row.get("PE_ltp") if pe_iv_row else None,
+    )
+
+
+def get_straddle_info(rows, underlying):
+    if not rows or underlying is None:
+        return None, None, None, None
+
+    summary = _summarize_rows(rows, underlying)
+    atm_strike, ce_row, pe_row = summary.atm_strike, summary.ce_row, summary.pe_row
+
     if not ce_row or not pe_row:
         return None, None, None, None
 
@@ -217,167 +373,160 @@ def build_strategy(ce_hits, pe_hits):
 
 
 # ------------------ Flask + SocketIO ------------------
-app = Flask(__name__, template_folder='templates', static_folder='static')
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+_ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
 
-# Track active realtime tasks per session id
-_realtime_tasks = {}  # sid -> {'running': True/False}
 
+class ORJSONProvider(JSONProvider):
+    """jsonify()/request.get_json() via orjson; NumPy values serialize natively."""
 
-def scan_symbols(symbols, thr=5.0, side="ALL", overrides=None):
-    """
-    Run the same logic as /api/breakout_scan but return list of dicts (out).
-    This function is safe to call from background tasks.
-    """
-    if overrides is None:
-        overrides = {}
-    symbols = [s.upper().strip() for s in (symbols or []) if s]
-    out = []
-    for sym in symbols:
-        try:
-            # small buffer per symbol to be polite
-            time.sleep(0.15)
-            oc = get_json(oc_url(sym))
-            base = parse_rows(oc)
-            used = overrides.get(sym) or (base["expiries"][0] if base["expiries"] else None)
-            parsed = parse_rows(oc, chosen_expiry=used)
-            rows, under = parsed["rows"], parsed["underlying"]
-            if not rows or under is None:
-                logger.debug(f"No data for {sym}")
-                continue
-
-            atm_ce_strike, atm_ce_iv = nearest_strike_iv(rows, under, "CE")
-            atm_pe_strike, atm_pe_iv = nearest_strike_iv(rows, under, "PE")
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=_ORJSON_OPTS).decode()
 
-            atm_ce_ltp = None
-            atm_pe_ltp = None
-            for r in rows:
-                if r["strike"] == atm_ce_strike:
-                    atm_ce_ltp = r.get("CE_ltp")
-                if r["strike"] == atm_pe_strike:
-                    atm_pe_ltp = r.get("PE_ltp")
-
-            def build_hits(side_name, comp):
-                hits = []
-                if comp is None:
-                    return hits
-                for r in rows:
-                    iv = r.get(f"{side_name}_iv")
-                    ltp = r.get(f"{side_name}_ltp")
-                    if iv is None:
-                        continue
-                    strike = r["strike"]
-                    if strike is None:
-                        continue
-                    if side_name == "CE" and strike < under:
-                        continue
-                    if side_name == "PE" and strike > under:
-                        continue
-                    inc = iv - comp
-                    if inc >= thr:
-                        dist_pct = abs(strike - under) / under * 100.0
-                        hits.append({
-                            "strike": strike,
-                            "iv": iv,
-                            "ltp": ltp,
-                            "inc": round(inc, 2),
-                            "dist_pct": round(dist_pct, 2)
-                        })
-                hits.sort(key=lambda x: (x["inc"], -abs(x["dist_pct"])), reverse=True)
-                return hits
-
-            ce_hits = build_hits("CE", atm_ce_iv) if side in ("ALL", "CE") else []
-            pe_hits = build_hits("PE", atm_pe_iv) if side in ("ALL", "PE") else []
-
-            def best_from(hits):
-                if not hits:
-                    return {}
-                best = {"MaxJump": hits[0]}
-                best["ClosestATM"] = sorted(hits, key=lambda h: abs(h["dist_pct"]))[0]
-                return best
-
-            strategy = build_strategy(ce_hits, pe_hits)
-
-            out.append({
-                "symbol": sym,
-                "expiry_used": used or "-",
-                "underlying": round(under, 2) if under else 0,
-                "atm_ce_iv": round(atm_ce_iv, 2) if atm_ce_iv is not None else None,
-                "atm_pe_iv": round(atm_pe_iv, 2) if atm_pe_iv is not None else None,
-                "atm_ce_ltp": round(atm_ce_ltp, 2) if atm_ce_ltp is not None else None,
-                "atm_pe_ltp": round(atm_pe_ltp, 2) if atm_pe_ltp is not None else None,
-                "ce_hits": ce_hits or [],
-                "pe_hits": pe_hits or [],
-                "best": {
-                    "ce_hit_count": len(ce_hits),
-                    "pe_hit_count": len(pe_hits),
-                    "ce_max_inc": round(max((h["inc"] for h in ce_hits), default=0), 2),
-                    "pe_max_inc": round(max((h["inc"] for h in pe_hits), default=0), 2),
-                    "ce_hits": ce_hits or [],
-                    "pe_hits": pe_hits or [],
-                },
-                "strategy": strategy
-            })
-        except Exception as e:
-            logger.warning(f"Scan error for {sym}: {e}")
-            continue
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-    return out
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=DefaultJSONProvider.default, option=_ORJSON_OPTS)
+        return self._app.response_class(body, mimetype="application/json")
 
 
-# ------------------ REST Endpoints (kept mostly same) ------------------
-@app.route("/")
-def index():
-    return render_template("index.html")
+class ORJSONSocketIO:
+    """json-module shim for Socket.IO/Engine.IO packet encoding (stdlib kwargs are ignored)."""
 
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=_ORJSON_OPTS).decode()
 
-@app.route("/api/oc", methods=["GET"])
-def api_oc():
-    symbol = request.args.get("symbol", "SBIN").upper().strip()
-    if not symbol:
-        return jsonify({"error": "Symbol required"}), 400
-    expiry = request.args.get("expiry")
-    try:
-        oc = get_json(oc_url(symbol))
-        base = parse_rows(oc)
-        used = expiry or (base["expiries"][0] if base["expiries"] else None)
-        parsed = parse_rows(oc, chosen_expiry=used)
-        return jsonify({
-            "symbol": symbol,
-            "expiries": base["expiries"],
-            "expiry_used": used,
-            "underlying": parsed["underlying"],
-            "rows": parsed["rows"],
-        })
-    except Exception as e:
-        logger.error(f"API OC error for {symbol}: {e}")
-        return jsonify({"error": "Failed to fetch data"}), 500
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
 
 
-@app.route("/api/breakout_scan", methods=["POST"])
-def api_breakout_scan():
-    data = request.get_json(silent=True) or {}
-    symbols = [s.upper().strip() for s in (data.get("symbols") or []) if s]
+app = Flask(__name__, template_folder='templates', static_folder='static')
+app.json = ORJSONProvider(app)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet", json=ORJSONSocketIO)
+
+# Realtime subscriptions: clients asking for the same scan share one producer loop.
+# 'emit_lock' orders the loop's (set last + room emit) against a joiner's (send last + join room).
+_subscriptions = {}   # subscription key -> {'stop': Event, 'room': str, 'sids': set(), 'last': payload | None, 'emit_lock': Lock}
+_realtime_tasks = {}  # sid -> subscription key it is attached to
+_rt_lock = threading.Lock()  # guards _subscriptions, _realtime_tasks and each sub's 'sids'
+REALTIME_MAX_BACKOFF = 60  # seconds
+REALTIME_MAX_INTERVAL = 300  # seconds
+REALTIME_FULL_EVERY = max(1, int(os.getenv("RT_FULL_SNAPSHOT_EVERY", "20")))  # ticks between full frames
+MAX_SYMBOLS = int(os.getenv("RT_MAX_SYMBOLS", "500"))   # per subscription
+MAX_CLIENTS = int(os.getenv("RT_MAX_CLIENTS", "1000"))  # concurrently subscribed sids
+_rt_slots = threading.BoundedSemaphore(MAX_CLIENTS)     # one slot per sid in _realtime_tasks
+
+# Recent realtime scan results, reused when another loop asks for the same scan
+# within its interval (e.g. a client reconnecting, or one watchlist on two intervals).
+_scan_cache = TTLCache(maxsize=256, ttl=300)  # scan key -> (monotonic stamp, result)
+_scan_cache_lock = threading.Lock()
+
+_last_ts_cache = (0, "")  # (epoch second, ISO-8601 UTC string) shared by all loops
+
+
+def run_parallel(fn, symbols):
+    """
+    Call fn(sym) for every symbol on a thread pool and return the truthy
+    results in input order. NSE pacing happens per request in get_json(),
+    so symbols served from the option-chain cache never wait.
+    """
+    symbols = list(symbols)
     if not symbols:
-        return jsonify({"error": "At least one symbol required"}), 400
+        return []
+    with ThreadPoolExecutor(max_workers=min(SCAN_WORKERS, len(symbols))) as ex:
+        return [r for r in ex.map(fn, symbols) if r]
+
+
+def _scan_one(sym, thr, side, overrides):
+    """Breakout scan for a single symbol; returns the result dict or None."""
     try:
-        thr = float(data.get("threshold", 5.0))
-        if thr < 0:
-            return jsonify({"error": "Threshold must be >=0"}), 400
-    except ValueError:
-        return jsonify({"error": "Invalid threshold"}), 400
-    side = (data.get("side") or "ALL").upper()
-    if side not in ("ALL", "CE", "PE"):
-        return jsonify({"error": "Side must be ALL, CE, or PE"}), 400
-    overrides = data.get("expiry_overrides") or {}
+        base = fetch_chain(oc_url(sym))
+        used = overrides.get(sym) or (base["expiries"][0] if base["expiries"] else None)
+        rows, under = rows_for_expiry(base, used), base["underlying"]
+        if not rows or under is None:
+            logger.debug("No data for %s", sym)
+            return None
+
+        summary = _summarize_rows(rows, under)
+        atm_ce_iv, atm_pe_iv = summary.atm_ce_iv, summary.atm_pe_iv
+        atm_ce_ltp, atm_pe_ltp = summary.atm_ce_ltp, summary.atm_pe_ltp
+
+        # Numeric filtering runs as NumPy masks over the whole chain; row
+        # dicts are only built for the (few) strikes that qualify.
+        strike_arr = np.array([r["strike"] for r in rows], dtype=float)
+        dist_arr = np.abs(strike_arr - under) / under * 100.0
+
+        def build_hits(side_name, comp):
+            if comp is None:
+                return []
+            iv_key = f"{side_name}_iv"
+            iv_arr = np.array([r[iv_key] for r in rows], dtype=float)  # None -> nan
+            inc_arr = iv_arr - comp
+            if side_name == "CE":
+                mask = (inc_arr >= thr) & (strike_arr >= under)
+            else:
+                mask = (inc_arr >= thr) & (strike_arr <= under)
+            hits = []
+            for i in np.flatnonzero(mask):
+                r = rows[i]
+                hits.append({
+                    "strike": r["strike"],
+                    "iv": r[iv_key],
+                    "ltp": r.get(f"{side_name}_ltp"),
+                    "inc": round(float(inc_arr[i]), 2),
+                    "dist_pct": round(float(dist_arr[i]), 2)
+                })
+            hits.sort(key=lambda x: (x["inc"], -abs(x["dist_pct"])), reverse=True)
+            return hits
+
+        ce_hits = build_hits("CE", atm_ce_iv) if side in ("ALL", "CE") else []
+        pe_hits = build_hits("PE", atm_pe_iv) if side in ("ALL", "PE") else []
+
+        strategy = build_strategy(ce_hits, pe_hits)
+
+        return {
+            "symbol": sym,
+            "expiry_used": used or "-",
+            "underlying": round(under, 2) if under else 0,
+            "atm_ce_iv": round(atm_ce_iv, 2) if atm_ce_iv is not None else None,
+            "atm_pe_iv": round(atm_pe_iv, 2) if atm_pe_iv is not None else None,
+            "atm_ce_ltp": round(atm_ce_ltp, 2) if atm_ce_ltp is not None else None,
+            "atm_pe_ltp": round(atm_pe_ltp, 2) if atm_pe_ltp is not None else None,
+            "ce_hits": ce_hits or [],
+            "pe_hits": pe_hits or [],
+            "best": {
+                "ce_hit_count": len(ce_hits),
+                "pe_hit_count": len(pe_hits),
+                # hits are sorted by inc (desc), so the max is the head
+                "ce_max_inc": ce_hits[0]["inc"] if ce_hits else 0,
+                "pe_max_inc": pe_hits[0]["inc"] if pe_hits else 0,
+                "ce_hits": ce_hits or [],
+                "pe_hits": pe_hits or [],
+            },
+            "strategy": strategy
+        }
+    except Exception as e:
+        logger.warning("Scan error for %s: %s", sym, e)
+        return None
 
-    out = scan_symbols(symbols, thr=thr, side=side, overrides=overrides)
-    return jsonify({"data": out, "ts": datetime.now(timezone.utc).isoformat()})
 
+def scan_symbols(symbols, thr=5.0, side="ALL", overrides=None):
+    """
+    Run the same logic as /api/breakout_scan but return list of dicts (out).
+    This function is safe to call from background tasks.
+    """
+    if overrides is None:
+        overrides = {}
+    symbols = [s.upper().strip() for s in (symbols or []) if s]
+    return run_parallel(lambda sym: _scan_one(sym, thr, side, overrides), symbols)
 
-@app.route("/api/suggested", methods=["GET"])
-def api_suggested():
-    popular = [
+
+# ------------------ Reference data ------------------
+# Built once at import; request handlers only read these.
+POPULAR = [
     "360ONE", "ABB", "APLAPOLLO", "AUBANK", "ADANIENSOL", "ADANIENT", "ADANIGREEN", "ADANIPORTS",
     "ABCAPITAL", "ALKEM", "AMBER", "AMBUJACEM", "ANGELONE", "APOLLOHOSP", "ASHOKLEY", "ASIANPAINT",
     "ASTRAL", "AUROPHARMA", "DMART", "AXISBANK", "BSE", "BAJAJ-AUTO", "BAJFINANCE", "BAJAJFINSV",
@@ -405,33 +554,11 @@ def api_suggested():
     "TITAN", "TORNTPHARM", "TORNTPOWER", "TRENT", "TIINDIA", "UNOMINDA", "UPL", "ULTRACEMCO",
     "UNIONBANK", "UNITDSPR", "VBL", "VEDL", "IDEA", "VOLTAS", "WIPRO", "YESBANK",
     "ZYDUSLIFE"
-    ]
-    return jsonify({"symbols": popular})
-
-
-# ---- strategy_ltp_scan (copied from original app.py) ----
-@app.route("/api/strategy_ltp_scan", methods=["POST"])
-def api_strategy_ltp_scan():
-    data = request.get_json(silent=True) or {}
-    symbols = [s.upper().strip() for s in (data.get("symbols") or []) if s][:210]
-    if not symbols:
-        symbols = ["NIFTY", "BANKNIFTY", "RELIANCE", "TCS"]
-
-    try:
-        buy_lots = int(data.get("buy_lots", 1))
-        sell_lots = int(data.get("sell_lots", 3))
-        target = float(data.get("target_diff", 6.0))
-        tolerance = float(data.get("tolerance", 1.0))
-        side = (data.get("side") or "ALL").upper()
-        atm_from_pct = float(data.get("atm_from_pct", 0.0))
-        atm_to_pct = float(data.get("atm_to_pct", 5.0))
-        min_strike_diff = float(data.get("min_strike_diff", 1.0))
-        max_strike_diff = float(data.get("max_strike_diff", 10.0))
-    except:
-        return jsonify({"error": "Invalid inputs"}), 400
+]
+_SUGGESTED_RESPONSE = orjson.dumps({"symbols": POPULAR})
 
-    LOT_SIZES = {
-   '360ONE': 500,
+LOT_SIZES = {
+    '360ONE': 500,
     'ABB': 125,
     'ABCAPITAL': 3100,
     'ADANIENSOL': 675,
@@ -644,24 +771,96 @@ def api_strategy_ltp_scan():
     'WIPRO': 3000,
     'YESBANK': 31100,
     'ZYDUSLIFE': 900
-    }
+}
+
+
+# ------------------ REST Endpoints (kept mostly same) ------------------
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+
+@app.route("/api/oc", methods=["GET"])
+def api_oc():
+    symbol = request.args.get("symbol", "SBIN").upper().strip()
+    if not symbol:
+        return jsonify({"error": "Symbol required"}), 400
+    expiry = request.args.get("expiry")
+    try:
+        base = fetch_chain(oc_url(symbol))
+        used = expiry or (base["expiries"][0] if base["expiries"] else None)
+        return jsonify({
+            "symbol": symbol,
+            "expiries": base["expiries"],
+            "expiry_used": used,
+            "underlying": base["underlying"],
+            "rows": rows_for_expiry(base, used),
+        })
+    except Exception as e:
+        logger.error("API OC error for %s: %s", symbol, e)
+        return jsonify({"error": "Failed to fetch data"}), 500
+
+
+@app.route("/api/breakout_scan", methods=["POST"])
+def api_breakout_scan():
+    data = request.get_json(silent=True) or {}
+    symbols = [s.upper().strip() for s in (data.get("symbols") or []) if s]
+    if not symbols:
+        return jsonify({"error": "At least one symbol required"}), 400
+    try:
+        thr = float(data.get("threshold", 5.0))
+        if thr < 0:
+            return jsonify({"error": "Threshold must be >=0"}), 400
+    except ValueError:
+        return jsonify({"error": "Invalid threshold"}), 400
+    side = (data.get("side") or "ALL").upper()
+    if side not in ("ALL", "CE", "PE"):
+        return jsonify({"error": "Side must be ALL, CE, or PE"}), 400
+    overrides = data.get("expiry_overrides") or {}
+
+    out = scan_symbols(symbols, thr=thr, side=side, overrides=overrides)
+    return jsonify({"data": out, "ts": datetime.now(timezone.utc).isoformat()})
+
+
+@app.route("/api/suggested", methods=["GET"])
+def api_suggested():
+    return Response(_SUGGESTED_RESPONSE, mimetype="application/json")
+
+
+# ---- strategy_ltp_scan (copied from original app.py) ----
+@app.route("/api/strategy_ltp_scan", methods=["POST"])
+def api_strategy_ltp_scan():
+    data = request.get_json(silent=True) or {}
+    symbols = [s.upper().strip() for s in (data.get("symbols") or []) if s][:210]
+    if not symbols:
+        symbols = ["NIFTY", "BANKNIFTY", "RELIANCE", "TCS"]
+
+    try:
+        buy_lots = int(data.get("buy_lots", 1))
+        sell_lots = int(data.get("sell_lots", 3))
+        target = float(data.get("target_diff", 6.0))
+        tolerance = float(data.get("tolerance", 1.0))
+        side = (data.get("side") or "ALL").upper()
+        atm_from_pct = float(data.get("atm_from_pct", 0.0))
+        atm_to_pct = float(data.get("atm_to_pct", 5.0))
+        min_strike_diff = float(data.get("min_strike_diff", 1.0))
+        max_strike_diff = float(data.get("max_strike_diff", 10.0))
+    except:
+        return jsonify({"error": "Invalid inputs"}), 400
 
     def lot_for(sym):
         return LOT_SIZES.get(sym.upper(), 1)
 
-    out = []
-    for sym in symbols:
+    def scan_one(sym):
         try:
-            oc = get_json(oc_url(sym))
-            base = parse_rows(oc)
+            base = fetch_chain(oc_url(sym))
             used = data.get("expiry_overrides", {}).get(sym) or (base["expiries"][0] if base["expiries"] else None)
-            parsed = parse_rows(oc, chosen_expiry=used)
-            rows, under = parsed["rows"], parsed["underlying"]  # <--- PEHLE YEH
+            rows, under = rows_for_expiry(base, used), base["underlying"]  # <--- PEHLE YEH
 
             # Ab straddle calculate karo
             straddle_price, straddle_iv, atm_strike, straddle_label = get_straddle_info(rows, under)
             if not rows or under is None:
-                continue
+                return None
 
             # Build strike map (filter ATM range)
             strike_map = {}
@@ -678,180 +877,251 @@ def api_strategy_ltp_scan():
                 }
 
             if not strike_map:
-                continue
+                return None
 
             strikes = sorted(strike_map.keys())
             matches = []
-            atm_strike = min(strikes, key=lambda x: abs(x - under))
+            i = bisect_left(strikes, under)
+            atm_strike = min(strikes[max(0, i - 1):i + 1], key=lambda x: abs(x - under))
 
             sides = ["CE", "PE"] if side == "ALL" else [side]
+            lot = lot_for(sym)
+
+            # All (buy, sell) strike pairs at once: rows index the buy
+            # strike, columns the sell strike.
+            strike_arr = np.array(strikes, dtype=float)
+            pair_diff_pct = np.abs(strike_arr[None, :] - strike_arr[:, None]) / under * 100.0
+            pair_ok = (pair_diff_pct >= min_strike_diff) & (pair_diff_pct <= max_strike_diff)
 
             for side_name in sides:
                 buy_side = sell_side = side_name
-                buy_key = f"{buy_side}_ltp"
-                sell_key = f"{sell_side}_ltp"
-
-                for buy_strike in strikes:
-                    if buy_side == "CE" and buy_strike < atm_strike:
-                        continue
-                    if buy_side == "PE" and buy_strike > atm_strike:
-                        continue
-
-                    buy_ltp = strike_map[buy_strike].get(buy_key)
-                    if buy_ltp is None:
-                        continue
-
-                    if buy_side == "CE":
-                        sell_strikes = [s for s in strikes if s > buy_strike]
-                    else:
-                        sell_strikes = [s for s in strikes if s < buy_strike]
-
-                    for sell_strike in sell_strikes:
-                        sell_ltp = strike_map[sell_strike].get(sell_key)
-                        if sell_ltp is None:
-                            continue
-                        diff_pct = abs(sell_strike - buy_strike) / under * 100.0 if under else 0.0
-                        if diff_pct < min_strike_diff or diff_pct > max_strike_diff:
-                            continue
-
-                        net = (buy_ltp * buy_lots) - (sell_ltp * sell_lots)
-                        abs_net = abs(net)
-
-                        if (target - tolerance) <= abs_net <= (target + tolerance):
-                            lot = lot_for(sym)
-                            total_pnl = net * lot
-                            matches.append({
-                                "buy_strike": buy_strike,
-                                "sell_strike": sell_strike,
-                                "buy_side": buy_side,
-                                "sell_side": sell_side,
-                                "buy_ltp": round(buy_ltp, 2),
-                                "sell_ltp": round(sell_ltp, 2),
-                                "net_per_lot": round(net, 2),
-                                "total_pnl": round(total_pnl),
-                                "lot_size": lot,
-                                "expiry": used
-                            })
+                key = f"{side_name}_ltp"
+                ltp_list = [strike_map[k][key] for k in strikes]
+                ltp_arr = np.array([np.nan if v is None else v for v in ltp_list], dtype=float)
+
+                if side_name == "CE":
+                    buy_ok = strike_arr >= atm_strike
+                    order_ok = strike_arr[None, :] > strike_arr[:, None]
+                else:
+                    buy_ok = strike_arr <= atm_strike
+                    order_ok = strike_arr[None, :] < strike_arr[:, None]
+
+                net = ltp_arr[:, None] * buy_lots - ltp_arr[None, :] * sell_lots
+                abs_net = np.abs(net)
+                mask = (
+                    pair_ok & order_ok & buy_ok[:, None]
+                    & (abs_net >= target - tolerance) & (abs_net <= target + tolerance)
+                )
+
+                for i, j in np.argwhere(mask):
+                    pair_net = float(net[i, j])
+                    matches.append({
+                        "buy_strike": strikes[i],
+                        "sell_strike": strikes[j],
+                        "buy_side": buy_side,
+                        "sell_side": sell_side,
+                        "buy_ltp": round(ltp_list[i], 2),
+                        "sell_ltp": round(ltp_list[j], 2),
+                        "net_per_lot": round(pair_net, 2),
+                        "total_pnl": round(pair_net * lot),
+                        "lot_size": lot,
+                        "expiry": used
+                    })
 
             if matches:
-                out.append({
+                return {
                     "symbol": sym,
                     "underlying": under,
                     "expiry_used": used,
                     "matches": matches
-                })
+                }
 
         except Exception as e:
-            logger.warning(f"Error in {sym}: {e}")
-            continue
+            logger.warning("Error in %s: %s", sym, e)
+        return None
 
+    out = run_parallel(scan_one, symbols)
     return jsonify({"data": out})
 # ==================== PREMIUM SURGE DETECTOR (FULL WORKING) ====================
 
 import time
 from datetime import datetime
 
-last_ltp = {}  # STORE PREVIOUS LTP FOR COMPARISON
+# STORE PREVIOUS LTP FOR COMPARISON
+# (symbol, expiry) -> {"strike": float[S] (sorted), "ltp": float[2, S], "ts": float[2, S]}
+# Row 0 of ltp/ts is CE, row 1 is PE; nan marks a strike/side not seen yet.
+# Bounded: chains not polled for SURGE_STATE_TTL seconds age out, and the
+# janitor task drops expiries that have rolled off.
+SURGE_STATE_TTL = 24 * 3600
+SURGE_JANITOR_INTERVAL = 3600
+last_ltp = TTLCache(maxsize=2048, ttl=SURGE_STATE_TTL)
+_surge_lock = threading.Lock()  # guards last_ltp (TTLCache is not thread-safe)
+_surge_janitor_started = False
+
+SURGE_SIDES = ("CE", "PE")
+
+
+def _surge_state(symbol, expiry, strikes):
+    """Columnar LTP history for (symbol, expiry), grown to cover sorted `strikes`."""
+    key = (symbol, expiry)
+    state = last_ltp.get(key)
+    if state is None:
+        n = len(strikes)
+        state = {"strike": strikes, "ltp": np.full((2, n), np.nan), "ts": np.full((2, n), np.nan)}
+        last_ltp[key] = state
+        return state
+
+    known = state["strike"]
+    merged = np.union1d(known, strikes)
+    if len(merged) != len(known):
+        # New strikes listed: re-home the existing history into wider arrays
+        pos = np.searchsorted(merged, known)
+        ltp = np.full((2, len(merged)), np.nan)
+        ts = np.full((2, len(merged)), np.nan)
+        ltp[:, pos] = state["ltp"]
+        ts[:, pos] = state["ts"]
+        state = {"strike": merged, "ltp": ltp, "ts": ts}
+    # Re-set on every poll so actively watched chains never hit the TTL
+    last_ltp[key] = state
+    return state
+
+
+def _expiry_date(expiry):
+    try:
+        return datetime.strptime(expiry, "%d-%b-%Y").date()
+    except (TypeError, ValueError):
+        return None
 
-def check_surge(symbol, expiry, strike, side, ltp, min_pct):
-    key = f"{symbol}_{expiry}_{strike}_{side}"
 
-    ts = time.time()
+def purge_expired_surge_state():
+    """Drop surge history for expiries that are already past; returns how many were evicted."""
+    today = datetime.now().date()
+    with _surge_lock:
+        last_ltp.expire()
+        stale = [key for key in list(last_ltp.keys())
+                 if (_expiry_date(key[1]) or today) < today]
+        for key in stale:
+            last_ltp.pop(key, None)
+    return len(stale)
 
-    # If no previous data → store and skip detection
-    if key not in last_ltp:
-        last_ltp[key] = {"ltp": ltp, "ts": ts}
-        return None
 
-    prev = last_ltp[key]
-    old = prev["ltp"]
+def _surge_janitor():
+    while True:
+        try:
+            evicted = purge_expired_surge_state()
+            if evicted:
+                logger.info("Surge cache: evicted %d expired chains", evicted)
+        except Exception as e:
+            logger.warning("Surge cache purge failed: %s", e)
+        socketio.sleep(SURGE_JANITOR_INTERVAL)
 
-    # Update storage for next comparison
-    last_ltp[key] = {"ltp": ltp, "ts": ts}
 
-    if old <= 0 or ltp <= 0:
-        return None
+def _ensure_surge_janitor():
+    global _surge_janitor_started
+    with _surge_lock:
+        if _surge_janitor_started:
+            return
+        _surge_janitor_started = True
+    socketio.start_background_task(_surge_janitor)
 
-    # Calculate % jump
-    jump = ((ltp - old) / old) * 100
-    jump = round(jump, 2)
 
-    if jump < min_pct:
-        return None
+def check_surges(symbol, expiry, rows, min_pct, time_str=None):
+    """
+    Compare every strike's CE/PE LTP with the previous poll and return surge items.
+    time_str (HH:MM:SS) is stamped on every item; callers scanning many symbols
+    pass one shared value.
+    """
+    if not rows:
+        return []
+
+    strikes = np.array([r["strike"] for r in rows], dtype=float)
+    curr = np.array([[r["CE_ltp"] for r in rows], [r["PE_ltp"] for r in rows]], dtype=float)
+    has_ltp = ~np.isnan(curr)
+    ts = time.time()
 
-    # Speed
-    seconds = ts - prev["ts"]
-    if seconds <= 0:
-        seconds = 1
-    speed = round(jump / seconds, 2)
+    with _surge_lock:
+        state = _surge_state(symbol, expiry, np.unique(strikes))
+        idx = np.searchsorted(state["strike"], strikes)
+        prev = state["ltp"][:, idx]
+        prev_ts = state["ts"][:, idx]
 
-    # Strength
-    strength = round(jump * speed, 2)
+        # Update storage for next comparison (sides without an LTP keep their history)
+        state["ltp"][:, idx] = np.where(has_ltp, curr, prev)
+        state["ts"][:, idx] = np.where(has_ltp, ts, prev_ts)
+
+    # Calculate % jump for the whole chain; first sighting (prev = nan) never matches.
+    # The slack lets values that round up to min_pct through to the exact check below.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        raw_jump = (curr - prev) / prev * 100
+    candidates = has_ltp & (prev > 0) & (curr > 0) & (raw_jump >= min_pct - 0.01)
+
+    # Candidate hits in row order, CE before PE within a strike
+    row_idx, side_idx = np.nonzero(candidates.T)
+    if not len(row_idx):
+        return []
+
+    # Python round() on the few candidates keeps jump_pct identical to the scalar formula
+    jump = np.array([round(j, 2) for j in raw_jump[side_idx, row_idx].tolist()])
+    keep = jump >= min_pct
+    row_idx, side_idx, jump = row_idx[keep], side_idx[keep], jump[keep]
+
+    # Speed: % per second since the previous poll of that strike/side
+    seconds = ts - prev_ts[side_idx, row_idx]
+    seconds = np.where(seconds <= 0, 1.0, seconds)
 
     # Type category
-    if jump >= 1000:
-        surge_type = "NUCLEAR"
-    elif jump >= 600:
-        surge_type = "EXTREME"
-    elif jump >= 350:
-        surge_type = "STRONG"
-    else:
-        surge_type = "NORMAL"
-
-    return {
-        "time": datetime.now().strftime("%H:%M:%S"),
-        "symbol": symbol,
-        "expiry": expiry,
-        "strike": strike,
-        "side": side,
-        "old": round(old, 2),
-        "new": round(ltp, 2),
-        "jump_pct": jump,
-        "speed": speed,
-        "lots": 1,
-        "strength": strength,
-        "type": surge_type
-    }
+    surge_type = np.select(
+        [jump >= 1000, jump >= 600, jump >= 350], ["NUCLEAR", "EXTREME", "STRONG"], default="NORMAL"
+    )
+
+    if time_str is None:
+        time_str = datetime.now().strftime("%H:%M:%S")
+    items = []
+    for i, s, jump_pct, secs, old, ltp, kind in zip(
+        row_idx.tolist(), side_idx.tolist(), jump.tolist(), seconds.tolist(),
+        prev[side_idx, row_idx].tolist(), curr[side_idx, row_idx].tolist(), surge_type.tolist(),
+    ):
+        speed = round(jump_pct / secs, 2)
+        items.append({
+            "time": time_str,
+            "symbol": symbol,
+            "expiry": expiry,
+            "strike": rows[i]["strike"],
+            "side": SURGE_SIDES[s],
+            "old": round(old, 2),
+            "new": round(ltp, 2),
+            "jump_pct": jump_pct,
+            "speed": speed,
+            "lots": 1,
+            "strength": round(jump_pct * speed, 2),
+            "type": kind
+        })
+    return items
 
 
 @app.route("/api/premium_surge", methods=["POST"])
 def premium_surge_api():
     data = request.get_json(silent=True) or {}
+    _ensure_surge_janitor()
 
     symbols = data.get("symbols", [])
     min_pct = float(data.get("min_pct", 250))
+    time_str = datetime.now().strftime("%H:%M:%S")
 
-    results = []
-
-    for sym in symbols:
+    def scan_one(sym):
         try:
-            oc = get_json(oc_url(sym))
-            base = parse_rows(oc)
+            base = fetch_chain(oc_url(sym))
 
             # Select nearest expiry
             expiry = base["expiries"][0] if base["expiries"] else None
-            parsed = parse_rows(oc, chosen_expiry=expiry)
-
-            for r in parsed["rows"]:
-                for side in ("CE", "PE"):
-                    ltp = r.get(f"{side}_ltp")
-                    if ltp is None:
-                        continue
-
-                    item = check_surge(
-                        sym,
-                        expiry,
-                        r["strike"],
-                        side,
-                        ltp,
-                        min_pct
-                    )
-
-                    if item:
-                        results.append(item)
+
+            return check_surges(sym, expiry, rows_for_expiry(base, expiry), min_pct, time_str)
 
         except Exception as e:
             print("SURGE ERROR:", sym, e)
+        return []
+
+    results = [item for hits in run_parallel(scan_one, symbols) for item in hits]
 
     # Sort by biggest jump first
     results.sort(key=lambda x: -x["jump_pct"])
@@ -859,79 +1129,268 @@ def premium_surge_api():
     return jsonify({"data": results})
 
 
-if __name__ == "__main__":
-    prime()
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+# ------------------ SocketIO Handlers ------------------
+def _normalize_subscription(symbols, overrides):
+    """Uppercase/strip/dedupe symbols (order kept) and keep only non-empty overrides for them."""
+    # Payloads come straight from the client: ignore wrongly-typed fields instead of raising
+    if not isinstance(symbols, (list, tuple)):
+        symbols = []
+    if not isinstance(overrides, dict):
+        overrides = {}
+    seen = set()
+    # Only non-empty strings count: str(None) would otherwise become the ticker "NONE"
+    symbols = [s for s in (x.strip().upper() for x in symbols if isinstance(x, str)) if s and not (s in seen or seen.add(s))]
+    overrides = {k.strip().upper(): str(v) for k, v in overrides.items() if isinstance(k, str) and v}
+    return symbols, {k: v for k, v in overrides.items() if k in seen}
 
 
+def _scan_key(symbols, thr, side, overrides):
+    # Symbol order is kept in the key: scan_symbols() returns rows in input order.
+    frozen_overrides = tuple(sorted((str(k), str(v)) for k, v in overrides.items()))
+    return (tuple(symbols), thr, side, frozen_overrides)
+
+
+def _subscription_key(symbols, thr, side, overrides, interval):
+    return _scan_key(symbols, thr, side, overrides) + (interval,)
+
+
+def _room_name(key):
+    return "rt-" + hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+
+def _iso_now():
+    """UTC ISO timestamp at one-second resolution, formatted once per second."""
+    global _last_ts_cache
+    now = int(time.time())
+    cached = _last_ts_cache
+    if cached[0] != now:
+        cached = (now, datetime.fromtimestamp(now, timezone.utc).isoformat())
+        _last_ts_cache = cached  # single tuple swap, safe without a lock
+    return cached[1]
+
+
+def _cached_scan(symbols, thr, side, overrides, interval):
+    """scan_symbols() memoized for just under one interval, keyed on the scan parameters."""
+    key = _scan_key(symbols, thr, side, overrides)
+    now = time.monotonic()
+    with _scan_cache_lock:
+        hit = _scan_cache.get(key)
+    if hit is not None and now - hit[0] < max(interval - 1, interval / 2):
+        return hit[1]
+    out = scan_symbols(symbols, thr=thr, side=side, overrides=overrides)
+    with _scan_cache_lock:
+        _scan_cache[key] = (now, out)
+    return out
+
+
+def _realtime_loop(key, sub, symbols, thr, side, overrides, interval):
+    """
+    Producer loop for one subscription, run via socketio.start_background_task so
+    it lives on the server's async runtime (a green thread under eventlet/gevent).
+    Each cycle scans once and broadcasts the result to the subscription's room; the
+    loop ends as soon as the last subscriber leaves (sub['stop'] is set), even mid-sleep.
+
+    Frames carry a per-subscription `seq`. The first and every REALTIME_FULL_EVERY-th
+    frame is a full snapshot ({"full": True, "data": [...]}); the rest are diffs
+    against the previous frame ({"patch": [changed rows], "removed": [symbols]}).
+    sub['last'] always holds the full snapshot for the latest seq, for late joiners.
+    """
+    tag = f"{len(symbols)} symbols/{side}/{interval}s"
+    logger.info("Realtime loop started for %s symbols=%s", tag, symbols[:10])
+    interval = max(1, interval)
+    fail_count = 0
+    next_tick = time.monotonic()
+    stop = sub["stop"]
+    seq = 0
+    sent = {}  # symbol -> encoded row as of the last frame, to diff against
+    while not stop.is_set():
+        try:
+            # scan_symbols() gathers every symbol before returning, so each
+            # cycle is a single websocket frame regardless of watchlist size.
+            out = _cached_scan(symbols, thr, side, overrides, interval)
+            if stop.is_set():
+                break  # last subscriber left while we were scanning
+            ts = _iso_now()
+            encoded = {
+                row["symbol"]: orjson.dumps(row, default=DefaultJSONProvider.default, option=_ORJSON_OPTS)
+                for row in out
+            }
+            seq += 1
+            snapshot = {"full": True, "seq": seq, "data": out, "ts": ts}
+            if not sent or seq % REALTIME_FULL_EVERY == 0:
+                payload = snapshot
+            else:
+                payload = {
+                    "seq": seq,
+                    "patch": [row for row in out if sent.get(row["symbol"]) != encoded[row["symbol"]]],
+                    "removed": [sym for sym in sent if sym not in encoded],
+                    "ts": ts,
+                }
+            sent = encoded
+            with sub["emit_lock"]:
+                sub["last"] = snapshot
+                # One room emit: the packet is encoded once and written to every subscriber
+                socketio.emit("update_data", payload, to=sub["room"])
+            fail_count = 0
+            delay = interval
+        except Exception as e:
+            # Back off on repeated failures, but never poll slower than max(interval, 60s)
+            fail_count += 1
+            delay = min(interval * 2 ** (fail_count - 1), max(interval, REALTIME_MAX_BACKOFF))
+            logger.warning("Realtime scan error for %s (retry in %ss): %s", tag, delay, e)
+        # Pace against a monotonic deadline so scan time doesn't add to the period;
+        # if a scan overran the whole slot, skip the missed ticks instead of bursting.
+        next_tick += delay
+        sleep_for = next_tick - time.monotonic()
+        if sleep_for > 0:
+            if stop.wait(sleep_for):
+                break
+        else:
+            next_tick = time.monotonic()
+            socketio.sleep(0)
+    logger.info("Realtime loop stopped for %s", tag)
+
+
+def _detach_locked(sid, leave=True):
+    """
+    Remove sid from its subscription (caller holds _rt_lock); returns the sub if it is now orphaned.
+    Bookkeeping happens before leave_room so a failure there can't leak the subscription.
+    """
+    key = _realtime_tasks.pop(sid, None)
+    sub = _subscriptions.get(key)
+    if sub is None:
+        return None
+    sub["sids"].discard(sid)
+    orphaned = not sub["sids"]
+    if orphaned:
+        del _subscriptions[key]
+    if leave:
+        leave_room(sub["room"], sid=sid)
+    return sub if orphaned else None
+
+
+def _unsubscribe(sid, leave=True):
+    """
+    Detach sid from its subscription, free its client slot and stop the producer
+    when nobody is left. Safe to call repeatedly or for a sid that never subscribed.
+    """
+    with _rt_lock:
+        if sid in _realtime_tasks:
+            _rt_slots.release()
+        orphan = _detach_locked(sid, leave=leave)
+    if orphan is not None:
+        orphan["stop"].set()
+
+
+def _subscribe(sid, symbols, thr, side, overrides, interval):
+    """
+    Attach sid to the shared loop for these parameters (starting it if needed) and
+    send it the loop's latest full snapshot, if any. Returns None on success, else
+    an error message for the client. Re-subscribing with identical parameters (a
+    client resync) only replays the snapshot and leaves the loop running.
+    """
+    key = _subscription_key(symbols, thr, side, overrides, interval)
+    orphan, dead, is_new, failed = None, None, False, False
+    with _rt_lock:
+        # Handlers run as separate tasks, so start_realtime can be processed after
+        # this sid's disconnect; registering it then would leak the entry and slot.
+        if not socketio.server.manager.is_connected(sid, request.namespace):
+            return "Client is no longer connected"
+        # A sid switching subscriptions keeps the slot it already holds
+        if sid not in _realtime_tasks and not _rt_slots.acquire(blocking=False):
+            return "Server is at its realtime client limit, try again later"
+        sub = _subscriptions.get(key) if _realtime_tasks.get(sid) == key else None
+        if sub is None:
+            # Detach + re-attach under one lock so a concurrent start/stop for the
+            # same sid can never leave it on two loops (or strand an orphaned one).
+            orphan = _detach_locked(sid)
+            sub = _subscriptions.get(key)
+            is_new = sub is None
+            if is_new:
+                sub = {"stop": threading.Event(), "room": _room_name(key), "sids": set(), "last": None,
+                       "emit_lock": threading.Lock()}
+                _subscriptions[key] = sub
+            sub["sids"].add(sid)
+            _realtime_tasks[sid] = key
+        try:
+            with sub["emit_lock"]:
+                # Snapshot N goes out before joining the room, so the first room frame
+                # this sid can receive is N+1 and the client's seq check lines up.
+                if sub["last"] is not None:
+                    socketio.emit("update_data", sub["last"], to=sid)
+                join_room(sub["room"], sid=sid)
+        except Exception as e:
+            # Undo the registration: slot, sid mapping and (if now empty) the subscription
+            logger.warning("Realtime subscribe failed for %s: %s", sid, e)
+            _rt_slots.release()
+            dead = _detach_locked(sid, leave=False)
+            failed = True
+    for gone in (orphan, dead):
+        if gone is not None:
+            gone["stop"].set()
+    if failed:
+        return "Realtime subscription failed"
+    if is_new:
+        socketio.start_background_task(_realtime_loop, key, sub, symbols, thr, side, overrides, interval)
+    return None
+
 
-# ------------------ SocketIO Handlers ------------------
 @socketio.on("connect")
 def handle_connect():
     sid = request.sid
-    logger.info(f"Client connected: {sid}")
-    _realtime_tasks[sid] = {"running": False}
+    logger.info("Client connected: %s", sid)
 
 @socketio.on("disconnect")
 def handle_disconnect():
     sid = request.sid
-    logger.info(f"Client disconnected: {sid}")
-    if sid in _realtime_tasks:
-        _realtime_tasks[sid]["running"] = False
-        del _realtime_tasks[sid]
+    logger.info("Client disconnected: %s", sid)
+    # Socket.IO drops the sid from every room itself once this handler returns,
+    # so only our registries, the client slot and the producer need releasing.
+    _unsubscribe(sid, leave=False)
 
 @socketio.on("start_realtime")
 def handle_start_realtime(data):
     sid = request.sid
-    logger.info(f"start_realtime from {sid} payload={data}")
+    logger.info("start_realtime from %s payload=%s", sid, data)
     symbols = data.get("symbols") or []
     try:
         thr = float(data.get("threshold") or 5.0)
-    except:
+    except (TypeError, ValueError):
         thr = 5.0
     side = (data.get("side") or "ALL").upper()
     if side not in ("ALL", "CE", "PE"):
         side = "ALL"
-    interval = int(data.get("interval") or 15)
-    overrides = data.get("expiry_overrides") or {}
-
-    # Stop previous if running
-    if sid in _realtime_tasks and _realtime_tasks[sid].get("running"):
-        _realtime_tasks[sid]["running"] = False
-
-    _realtime_tasks[sid] = {"running": True}
-
-    def _bg_loop():
-        logger.info(f"Realtime loop started for {sid} interval={interval}s symbols={symbols[:10]}")
-        while _realtime_tasks.get(sid, {}).get("running"):
-            try:
-                out = scan_symbols(symbols, thr=thr, side=side, overrides=overrides)
-                payload = {"data": out, "ts": datetime.now(timezone.utc).isoformat()}
-                socketio.emit("update_data", payload, to=sid)
-            except Exception as e:
-                logger.warning(f"Realtime scan error for {sid}: {e}")
-                time.sleep(max(1, interval))
-        logger.info(f"Realtime loop stopped for {sid}")
-
-    socketio.start_background_task(_bg_loop)
+    try:
+        interval = int(data.get("interval") or 15)
+    except (TypeError, ValueError):
+        interval = 15
+    interval = max(1, min(interval, REALTIME_MAX_INTERVAL))
+    symbols, overrides = _normalize_subscription(symbols, data.get("expiry_overrides") or {})
+    if not symbols:
+        _unsubscribe(sid)  # an empty watchlist replaces whatever this client was watching
+        emit("realtime_error", {"error": "At least one symbol required"})
+        return
+    if len(symbols) > MAX_SYMBOLS:
+        emit("realtime_error", {"error": f"Too many symbols (max {MAX_SYMBOLS})"})
+        return
+
+    # Re-subscribing detaches this client from any previous subscription first
+    # (joining an already-running scan also sends its latest snapshot right away)
+    error = _subscribe(sid, symbols, thr, side, overrides, interval)
+    if error:
+        emit("realtime_error", {"error": error})
+        return
     emit("realtime_started", {"ok": True})
 
 @socketio.on("stop_realtime")
-def handle_stop_realtime():
+def handle_stop_realtime(data=None):
     sid = request.sid
-    logger.info(f"stop_realtime from {sid}")
-    if sid in _realtime_tasks:
-        _realtime_tasks[sid]["running"] = False
+    logger.info("stop_realtime from %s", sid)
+    _unsubscribe(sid)
     emit("realtime_stopped", {"ok": True})
 
 
 if __name__ == "__main__":
-    logger.info(f"Starting server on port {PORT}")
+    prime()
+    logger.info("Starting server on port %s", PORT)
     socketio.run(app, host="0.0.0.0", port=PORT)
-    
-    import os
-
-if __name__ == "__main__":
-    port = int(os.getenv("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
-